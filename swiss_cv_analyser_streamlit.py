@@ -1,10 +1,17 @@
 import streamlit as st
-import pdfplumber
-import google.generativeai as genai
 import re
-import io
+import asyncio
+import hashlib
 import time
-from docxtpl import DocxTemplate, RichText
+from concurrent.futures import ThreadPoolExecutor
+from swiss_cv_core import (
+    GENERATION_CONFIG, MAX_OUTPUT_TOKENS, MAX_PAGES, REQUEST_OPTIONS, RateLimiter,
+    call_gemini, create_word_report, extract_pdf_bytes, parse_report, stream_gemini,
+)
+
+# genai is imported where it is used (as are the PDF and docx libraries in
+# swiss_cv_core): deferring them lets the page paint before a cold worker has
+# loaded them.
 
 # --- 1. Page Config ---
 st.set_page_config(page_title="Swiss CV Analyser PRO", page_icon="🇨🇭", layout="wide")
@@ -13,6 +20,7 @@ st.set_page_config(page_title="Swiss CV Analyser PRO", page_icon="🇨🇭", lay
 def configure_genai(key_index=1):
     """Switches between Primary and Backup keys."""
     try:
+        import google.generativeai as genai
         key_name = "GEMINI_API_KEY" if key_index == 1 else "GEMINI_API_KEY_2"
         api_key = st.secrets.get(key_name)
         if api_key:
@@ -22,101 +30,285 @@ def configure_genai(key_index=1):
     except:
         return False
 
-# Initial config with primary key
-configure_genai(1)
+# 2026 Stable model name
+_MODEL_NAME = "gemini-2.0-flash"
 
-def get_model():
-    # 2026 Stable model name
-    return genai.GenerativeModel("gemini-2.0-flash")
+def _discover_model_name():
+    """Only used once the fixed name 404s: the first flash model the key can generate with."""
+    import google.generativeai as genai
+    names = [m.name for m in genai.list_models() if "generateContent" in m.supported_generation_methods]
+    return next((name for name in names if "flash" in name), names[0])
 
-# --- 3. Text Extraction ---
-def extract_pdf_text(file):
-    if file is None: return ""
+@st.cache_resource
+def get_model(key_index=1):
+    # One instance per key: a model keeps the client (and so the API key) it
+    # first generated with.
+    import google.generativeai as genai
+    model = genai.GenerativeModel(_MODEL_NAME)
+    # Open the connection now, once per process, so the first analysis skips
+    # the TLS handshake. count_tokens is free and spends no generation quota,
+    # and a retired model name shows up here as a 404.
     try:
-        file.seek(0)
-        text = ""
-        with pdfplumber.open(io.BytesIO(file.read())) as pdf:
-            for page in pdf.pages:
-                content = page.extract_text()
-                if content: text += content + " "
-        return text.strip()
+        model.count_tokens("ok", request_options=REQUEST_OPTIONS)
     except Exception as e:
-        st.error(f"PDF Error: {e}")
-        return ""
+        if "404" in str(e):
+            try:
+                model = genai.GenerativeModel(_discover_model_name())
+            except Exception:
+                pass
+    return model
+
+# Free-tier requests per minute, counted per key: waiting locally for a slot
+# is cheaper than a 429 that burns the failover
+_RPM_LIMIT = 15
+
+@st.cache_resource
+def get_rate_limiter(key_index=1):
+    return RateLimiter(_RPM_LIMIT)
+
+# --- 3. Text Extraction ---
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _extract_pdf_bytes(digest, _data, max_pages):
+    """Cached on the BLAKE2 digest; the underscore stops Streamlit re-hashing the bytes."""
+    return extract_pdf_bytes(_data, max_pages)
+
+# Extraction threads per run; PDFium work is serialised anyway, so more only
+# helps the pdfminer fallback and OCR
+_EXTRACT_WORKERS = 4
+
+def _max_pages():
+    """MAX_PAGES from secrets (raise it for unusually long CVs), at least 1."""
+    try:
+        return max(1, int(st.secrets.get("MAX_PAGES", MAX_PAGES)))
+    except (TypeError, ValueError):
+        return MAX_PAGES
+
+def extract_pdf_texts(*files):
+    """Parses several uploads concurrently; a missing upload yields ""."""
+    # Bytes are read here on the script thread; workers only see immutable data
+    max_pages = _max_pages()
+    jobs = []
+    for file in files:
+        if file is None:
+            jobs.append(None)
+            continue
+        data = file.getvalue()
+        jobs.append((_digest(data), data, max_pages))
+    with ThreadPoolExecutor(max_workers=min(_EXTRACT_WORKERS, len(files))) as ex:
+        futures = [ex.submit(_extract_pdf_bytes, *job) if job else None for job in jobs]
+    texts = []
+    for future in futures:
+        try:
+            texts.append(future.result() if future else "")
+        except Exception as e:
+            st.error(f"PDF Error: {e}")
+            texts.append("")
+    return texts
 
 # --- 4. Smart Analysis with Failover ---
-def run_analysis_with_failover(cv_text, jd_text):
-    prompt = f"""
-    Evaluate this CV against the JD. Use '###' for headers. No bold (**).
-    NAME_START: [Candidate Name] NAME_END
-    CATEGORY: [READY/IMPROVE/MAJOR]
-    
-    ### 1. PERFORMANCE SCORECARD
-    ### 2. SWISS COMPLIANCE
-    ### 3. TECHNICAL ALIGNMENT
-    ### 4. IMPACT & KPIs
-    ### 5. PRIORITY ACTION PLAN
-
-    CV: {cv_text[:7000]}
-    JD: {jd_text[:3000]}
-    """
-    
+# Static instructions first, CV/JD last: the prompt prefix stays byte-identical
+# between calls, which is what Gemini's implicit prompt caching matches on.
+_REPORT_FORMAT = """Use '###' for headers. No bold (**).
+NAME_START: [Candidate Name] NAME_END
+CATEGORY: [READY/IMPROVE/MAJOR]
+
+### 1. PERFORMANCE SCORECARD
+### 2. SWISS COMPLIANCE
+### 3. TECHNICAL ALIGNMENT
+### 4. IMPACT & KPIs
+### 5. PRIORITY ACTION PLAN
+"""
+
+_ANALYSIS_TEMPLATE = """
+Evaluate this CV against the JD. """ + _REPORT_FORMAT + """
+CV: {cv}
+JD: {jd}
+"""
+
+_BATCH_TEMPLATE = """
+Evaluate each CV below against the JD, independently of the others.
+Start the report for CV n with a line '=== REPORT n ===', then use this format:
+""" + _REPORT_FORMAT + """
+{cvs}
+JD: {jd}
+"""
+
+# CVs per batched request; output tokens scale with it
+_BATCH_SIZE = 3
+_REPORT_SPLIT_RE = re.compile(r"^=== REPORT (\d+) ===[ \t]*$", re.M)
+
+# Input budgets in tokens, leaving headroom for the instructions themselves
+_CV_TOKEN_BUDGET = 6000
+_JD_TOKEN_BUDGET = 2000
+
+def _count_tokens(text):
+    """Token count from the primary key, or the backup once the primary hits a 429."""
+    for key_index in (1, 2):
+        if key_index == 2 and not configure_genai(2):
+            break
+        try:
+            return get_model(key_index).count_tokens(text, request_options=REQUEST_OPTIONS).total_tokens
+        except Exception as e:
+            if "429" not in str(e):
+                break
+    return None
+
+@st.cache_data(show_spinner=False)
+def _truncate_to_tokens(text, max_tokens):
+    """Cuts text to ~max_tokens, calibrating chars/token with one count_tokens call."""
+    if len(text) <= max_tokens:  # a token is at least one character
+        return text
+    total = _count_tokens(text)
+    if total is None:
+        total = len(text) // 4  # ~4 chars/token for English prose
+    if total <= max_tokens:
+        return text
+    return text[:len(text) * max_tokens // total]
+
+# Finished replies by prompt, shared across sessions so re-running the same
+# CV/JD pair costs no generation. Errors raise before reaching the cache.
+_RESPONSE_TTL = 24 * 3600
+_RESPONSE_MAX_ENTRIES = 256
+
+@st.cache_resource
+def _response_cache():
+    return {}
+
+def _response_key(prompt, generation_config):
+    data = f"{sorted(generation_config.items())}\n{prompt}".encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _cached_response(key):
+    hit = _response_cache().get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    return None
+
+def _store_response(key, text):
+    if not text:
+        return  # never let an empty reply stand in for a report
+    cache = _response_cache()
+    cache.pop(key, None)
+    cache[key] = (time.monotonic() + _RESPONSE_TTL, text)
+    # Dicts keep insertion order, so the first entry is the oldest
+    while len(cache) > _RESPONSE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)), None)
+
+async def _call_gemini_async(key_index, prompt, sem, generation_config):
+    """Runs the blocking SDK call in a worker thread, gated by the shared semaphore."""
+    key = _response_key(prompt, generation_config)
+    cached = _cached_response(key)
+    if cached is not None:
+        return cached
+    model = get_model(key_index)
+    async with sem:
+        text = await asyncio.to_thread(
+            call_gemini, model, prompt, generation_config=generation_config,
+            limiter=get_rate_limiter(key_index),
+        )
+    _store_response(key, text)
+    return text
+
+async def _with_failover(call):
+    """Awaits call(key_index) on the primary key, then on the backup after a 429."""
     # Try Primary Key
     try:
-        model = get_model()
-        response = model.generate_content(prompt)
-        return response.text.strip(), "Primary"
+        return await call(1), "Primary"
     except Exception as e:
         if "429" in str(e):
             # Try Backup Key
             st.warning("🔄 Primary Quota Full. Switching to Backup Account...")
             if configure_genai(2):
                 try:
-                    model = get_model()
-                    response = model.generate_content(prompt)
-                    return response.text.strip(), "Backup"
+                    return await call(2), "Backup"
                 except Exception as e2:
                     return f"ERROR: Both accounts exhausted for today. Reset at 15:00 Hanoi time. Details: {e2}", "None"
             else:
                 return "ERROR: Primary exhausted and no Backup Key found in secrets.", "None"
         return f"API Error: {e}", "None"
 
-# --- 5. Word Export (Unchanged logic) ---
-def create_word_report(report_text):
-    try:
-        doc = DocxTemplate("template.docx")
-        name_match = re.search(r"NAME_START:(.*?)NAME_END", report_text)
-        cand_name = name_match.group(1).strip() if name_match else "CANDIDATE"
-        cat_match = re.search(r"CATEGORY:(READY|IMPROVE|MAJOR)", report_text)
-        category = cat_match.group(1) if cat_match else "IMPROVE"
-        
-        rt = RichText()
-        clean_text = re.sub(r"NAME_START:.*?NAME_END", "", report_text)
-        clean_text = re.sub(r"CATEGORY:.*?\n", "", clean_text).replace("**", "")
-        
-        for line in clean_text.split('\n'):
-            line = line.strip()
-            if line.startswith('###'):
-                rt.add(line.replace('###', '').strip(), font='Calibri', size=28, color='1D457C')
-            else:
-                rt.add(line, font='Calibri', size=24, color='E7E6E6')
-            rt.add('\n')
-
-        context = {
-            'CANDIDATE_NAME': cand_name.upper(),
-            'REPORT_CONTENT': rt,
-            'REC_READY': "✅" if category == "READY" else "⬜",
-            'REC_IMPROVE': "✅" if category == "IMPROVE" else "⬜",
-            'REC_MAJOR': "✅" if category == "MAJOR" else "⬜",
-        }
-        doc.render(context)
-        bio = io.BytesIO()
-        doc.save(bio)
-        bio.seek(0)
-        return bio
-    except: return None
-
-# --- 6. Main UI ---
+async def _generate_with_failover(prompt, sem, generation_config=GENERATION_CONFIG):
+    return await _with_failover(
+        lambda key_index: _call_gemini_async(key_index, prompt, sem, generation_config)
+    )
+
+def _fit_to_budget(cv_texts, jd_text):
+    """Token-truncates the inputs. count_tokens is a blocking network call, so this
+    runs on the script thread before the event loop starts, never inside it."""
+    return (
+        [_truncate_to_tokens(cv, _CV_TOKEN_BUDGET) for cv in cv_texts],
+        _truncate_to_tokens(jd_text, _JD_TOKEN_BUDGET),
+    )
+
+def _build_prompt(cv_text, jd_text):
+    return _ANALYSIS_TEMPLATE.format(cv=cv_text, jd=jd_text)
+
+async def _analyse_with_failover(cv_text, jd_text, sem):
+    return await _generate_with_failover(_build_prompt(cv_text, jd_text), sem)
+
+async def _analyse_batch_with_failover(cv_texts, jd_text, sem):
+    """One request for several CVs; the reply is split back on the REPORT markers."""
+    cvs = "\n".join(f"=== CV {i} ===\n{cv}" for i, cv in enumerate(cv_texts, 1))
+    prompt = _BATCH_TEMPLATE.format(cvs=cvs, jd=jd_text)
+    config = {**GENERATION_CONFIG, "max_output_tokens": MAX_OUTPUT_TOKENS * len(cv_texts)}
+    text, source = await _generate_with_failover(prompt, sem, config)
+    if source == "None":
+        return [(text, source)] * len(cv_texts)
+    parts = _REPORT_SPLIT_RE.split(text)
+    reports = {int(n): body.strip() for n, body in zip(parts[1::2], parts[2::2])}
+    return [
+        (reports[i], source) if i in reports else ("ERROR: Report missing from batched reply.", "None")
+        for i in range(1, len(cv_texts) + 1)
+    ]
+
+async def run_analyses_async(pairs, max_concurrency=5):
+    """Analyses (cv_text, jd_text) pairs concurrently; returns (report, source) per pair.
+
+    Texts must already be cut to budget with _fit_to_budget.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+    return await asyncio.gather(*(_analyse_with_failover(cv, jd, sem) for cv, jd in pairs))
+
+async def run_batch_async(cv_texts, jd_text, max_concurrency=5):
+    """Sends CVs in groups of _BATCH_SIZE per request; groups run concurrently.
+
+    Texts must already be cut to budget with _fit_to_budget.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+    groups = [cv_texts[i:i + _BATCH_SIZE] for i in range(0, len(cv_texts), _BATCH_SIZE)]
+    results = await asyncio.gather(*(_analyse_batch_with_failover(g, jd_text, sem) for g in groups))
+    return [r for group in results for r in group]
+
+def run_analysis_with_failover(cv_text, jd_text):
+    (cv_text,), jd_text = _fit_to_budget([cv_text], jd_text)
+    return asyncio.run(run_analyses_async([(cv_text, jd_text)]))[0]
+
+def run_batch_analysis(cv_texts, jd_text):
+    cv_texts, jd_text = _fit_to_budget(cv_texts, jd_text)
+    return asyncio.run(run_batch_async(cv_texts, jd_text))
+
+def stream_analysis_with_failover(cv_text, jd_text):
+    """Returns (chunk iterator, source), or (error message, "None") on failure."""
+    (cv_text,), jd_text = _fit_to_budget([cv_text], jd_text)
+    prompt = _build_prompt(cv_text, jd_text)
+    key = _response_key(prompt, GENERATION_CONFIG)
+
+    async def open_stream(key_index):
+        cached = _cached_response(key)
+        if cached is not None:
+            return iter([cached])
+        return await asyncio.to_thread(
+            stream_gemini, get_model(key_index), prompt,
+            on_complete=lambda text: _store_response(key, text),
+            limiter=get_rate_limiter(key_index),
+        )
+
+    return asyncio.run(_with_failover(open_stream))
+
+# --- 5. Main UI ---
 st.title("🇨🇭 Swiss CV Analyser (Dual-Key Mode)")
 
 with st.sidebar:
@@ -126,22 +318,90 @@ with st.sidebar:
         st.stop()
     st.success("Authenticated")
 
-cv_file = st.file_uploader("Upload CV", type=["pdf"])
+# Initial config with primary key
+configure_genai(1)
+get_model(1)
+
+cv_files = st.file_uploader("Upload CV(s)", type=["pdf"], accept_multiple_files=True)
 jd_file = st.file_uploader("Upload JD", type=["pdf"])
 
+def offer_download(report, file_name, key):
+    """Builds the .docx only on request; the bytes then survive reruns in session_state."""
+    state_key = f"{key}_docx"
+    if st.button("📄 Prepare Word Report", key=f"{key}_prepare"):
+        word_file = create_word_report(report)
+        st.session_state[state_key] = (report, word_file.getvalue() if word_file else None)
+    # Tagged with the report text so a new analysis never offers the old file
+    prepared = st.session_state.get(state_key)
+    if prepared is None or prepared[0] != report:
+        return
+    if prepared[1] is None:
+        st.error("Could not build the Word report from the template.")
+    else:
+        st.download_button("📩 Download Report", prepared[1], file_name, key=key)
+
+def show_results(results):
+    """Renders stored (name, report, source) triples, e.g. on the rerun a download triggers."""
+    for i, (name, report, source) in enumerate(results):
+        if len(results) > 1:
+            st.subheader(name)
+        if source == "None":
+            st.error(report)
+        else:
+            st.caption(f"Used {source} Account")
+            # Same text as the Word export, without the NAME/CATEGORY markers
+            st.markdown(parse_report(report)[0])
+            file_name = f"Audit_{i + 1}.docx" if len(results) > 1 else "Audit.docx"
+            offer_download(report, file_name, f"download_{i}")
+
+# Results are kept per set of uploads, so widget reruns redisplay them instead
+# of losing them (or re-running the pipeline). Keyed on content, so a re-upload
+# of an edited file with the same name and size is not mistaken for the old one.
+upload_key = tuple(_digest(f.getvalue()) for f in cv_files) + (_digest(jd_file.getvalue()) if jd_file else None,)
+
 if st.button("🚀 Run Analysis"):
-    if cv_file:
+    if cv_files:
         with st.spinner("Processing with dual-account failover..."):
-            cv_raw = extract_pdf_text(cv_file)
-            jd_raw = extract_pdf_text(jd_file) if jd_file else "Standard Swiss Life Sciences JD"
-            
-            report, source = run_analysis_with_failover(cv_raw, jd_raw)
-            
-            if "ERROR" in report:
-                st.error(report)
+            *cv_raws, jd_raw = extract_pdf_texts(*cv_files, jd_file)
+            jd_raw = jd_raw or "Standard Swiss Life Sciences JD"
+
+            # A PDF with no text (scanned, without OCR installed) would only waste a call
+            readable = []
+            for cv_file, cv_raw in zip(cv_files, cv_raws):
+                if cv_raw:
+                    readable.append((cv_file.name, cv_raw))
+                else:
+                    st.error(f"{cv_file.name}: no text found. Is the PDF empty or scanned?")
+
+            if len(readable) == 1:
+                # Single CV: render tokens as they arrive
+                name, cv_raw = readable[0]
+                stream, source = stream_analysis_with_failover(cv_raw, jd_raw)
+                if source == "None":
+                    st.error(stream)
+                    report = stream
+                else:
+                    st.caption(f"Used {source} Account")
+                    placeholder = st.empty()
+                    try:
+                        report = placeholder.container().write_stream(stream)
+                    except Exception as e:
+                        # Partial text stays on screen but is neither cached nor exported
+                        report, source = f"API Error: {e}", "None"
+                        st.error(report)
+                    else:
+                        # Swap the raw stream for the marker-free body reruns show
+                        placeholder.markdown(parse_report(report)[0])
+                        offer_download(report, "Audit.docx", "download_0")
+                results = [(name, report, source)]
             else:
-                st.caption(f"Used {source} Account")
-                st.markdown(report)
-                word_file = create_word_report(report)
-                if word_file:
-                    st.download_button("📩 Download Report", word_file, "Audit.docx")
+                results = [
+                    (name, report, source)
+                    for (name, _), (report, source) in zip(
+                        readable, run_batch_analysis([cv for _, cv in readable], jd_raw)
+                    )
+                ]
+                show_results(results)
+        st.session_state["results"] = (upload_key, results)
+elif st.session_state.get("results", (None,))[0] == upload_key:
+    show_results(st.session_state["results"][1])
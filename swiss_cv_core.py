@@ -0,0 +1,331 @@
+"""Shared helpers for the Swiss CV analyser front ends (Streamlit app and CLI).
+
+Nothing here depends on Streamlit; caching and UI concerns stay in the callers.
+"""
+import importlib.util
+import io
+import itertools
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# The PDF libraries and python-docx are imported where they are used: they
+# are slow to import and not every caller needs them.
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.docx")
+
+# --- Text Extraction ---
+# PDF text often carries control chars (form feeds, NULs, C1 codes); map them to
+# spaces in one C-level translate pass instead of a regex scan.
+_CTRL_TABLE = dict.fromkeys(list(range(0, 32)) + list(range(127, 160)), ord(' '))
+
+def clean_text(text):
+    if not text: return ""
+    # Argument-less split() collapses whitespace in C, several times faster than \s+
+    return " ".join(text.translate(_CTRL_TABLE).split())
+
+# Low-signal sections removed before the token budget is spent on them. A
+# section runs until the next recognised heading or the end of its page, so
+# anything after it is kept.
+_SKIP_SECTION_RE = re.compile(r"[ \t]*(?:References|Hobbies|Interests)[ \t]*:?[ \t]*$", re.I)
+_SECTION_RE = re.compile(
+    r"[ \t]*(?:(?:Work |Professional )?Experience|Employment|Career|Education|Skills|Languages|"
+    r"Certifications?|Publications|Projects|Summary|Profile|Training|Awards|Achievements|"
+    r"Volunteering|Contact)\b",
+    re.I,
+)
+_URL_RE = re.compile(r"(?:https?://|www\.)\S+")
+
+# Running headers/footers sit within this many non-blank lines of a page edge
+_EDGE_LINES = 3
+
+def _edge_keys(lines):
+    """Maps line index to ("top"|"bottom", text) for the lines near each page edge."""
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    keys = {}
+    for edge, indices in (("top", filled[:_EDGE_LINES]), ("bottom", filled[-_EDGE_LINES:])):
+        for i in indices:
+            keys.setdefault(i, set()).add((edge, lines[i].strip()))
+    return keys
+
+def strip_boilerplate(text):
+    """Drops repeated running headers/footers, URL-only lines and References/Hobbies sections.
+
+    Expects pages separated by form feeds, as pdfminer emits them. A line
+    counts as a header (footer) only if it recurs near the top (bottom) of
+    most pages, so a body line such as "Responsibilities:" that happens to
+    recur stays. The first copy of a repeated line is kept, since headers
+    often carry the candidate's name.
+    """
+    pages = [page.splitlines() for page in text.split("\f")]
+    edges = [_edge_keys(lines) for lines in pages]
+    repeated = set()
+    if len(pages) > 1:
+        counts = Counter(key for keys in edges for key in set().union(*keys.values()))
+        repeated = {key for key, n in counts.items() if n > len(pages) / 2}
+    seen = set()
+    kept = []
+    for lines, keys in zip(pages, edges):
+        skipping = False
+        for i, line in enumerate(lines):
+            stripped = line.strip()
+            if keys.get(i, set()) & repeated:
+                if stripped in seen:
+                    continue
+                seen.add(stripped)
+            if _SKIP_SECTION_RE.match(line):
+                skipping = True
+                continue
+            if skipping and _SECTION_RE.match(line):
+                skipping = False
+            if skipping:
+                continue
+            if stripped and sum(map(len, _URL_RE.findall(stripped))) * 2 > len(stripped):
+                continue
+            kept.append(line)
+    return "\n".join(kept)
+
+# Pages past this would fall outside the prompt's token budget anyway
+MAX_PAGES = 10
+# Rasterisation resolution for OCR; tesseract is tuned for 200-300 dpi scans
+_OCR_DPI = 200
+# PDFium is not thread-safe: every call into it (open, text, render, close)
+# holds this lock, across extraction threads and Streamlit sessions alike
+_PDFIUM_LOCK = threading.Lock()
+
+def _ocr(images):
+    """OCR for scanned PDFs. Optional: needs pytesseract and the tesseract binary."""
+    try:
+        import pytesseract
+        # Each OCR call runs a tesseract subprocess, so pages can overlap
+        with ThreadPoolExecutor() as ex:
+            return "\f".join(ex.map(pytesseract.image_to_string, images))
+    except Exception:
+        return ""
+
+def _page_text(page):
+    """Text layer of one page, releasing PDFium's native page buffers straight away."""
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range()
+    finally:
+        textpage.close()
+        page.close()
+
+def extract_pdf_bytes(data, max_pages=MAX_PAGES):
+    import pypdfium2 as pdfium
+    images = []
+    with _PDFIUM_LOCK:
+        try:
+            pdf = pdfium.PdfDocument(data)
+        except pdfium.PdfiumError:
+            pdf = None
+        if pdf is not None:
+            try:
+                # Native text layer, pages separated by form feeds as pdfminer does
+                text = "\f".join(_page_text(page) for page in itertools.islice(pdf, max_pages))
+                # Image-only PDF: no text layer, so rasterize for OCR. The images
+                # are copied out of PDFium's buffers so OCR can run after unlocking.
+                if len(text.strip()) < 50 and importlib.util.find_spec("pytesseract"):
+                    images = [
+                        page.render(scale=_OCR_DPI / 72).to_pil().copy()
+                        for page in itertools.islice(pdf, max_pages)
+                    ]
+            finally:
+                pdf.close()
+    if pdf is None:
+        # pdfminer copes with some files PDFium refuses
+        from pdfminer.high_level import extract_text
+        return clean_text(strip_boilerplate(extract_text(io.BytesIO(data), maxpages=max_pages)))
+    if images:
+        text = _ocr(images) or text
+    return clean_text(strip_boilerplate(text))
+
+# --- Gemini Calls ---
+# Bounded output and a client-side timeout so a runaway response cannot hang the spinner
+MAX_OUTPUT_TOKENS = 2048
+GENERATION_CONFIG = {"max_output_tokens": MAX_OUTPUT_TOKENS, "temperature": 0.2}
+REQUEST_OPTIONS = {"timeout": 60}
+
+def _backoff(attempt, cap=32.0):
+    """Exponential delay with jitter, so concurrent sessions don't retry in lockstep."""
+    return min(2 ** attempt + random.uniform(0, 0.5), cap)
+
+def _retryable(e):
+    """Timeouts and 5xx may succeed on retry; 4xx (bad request, auth, quota) won't."""
+    if isinstance(e, ValueError):
+        return False  # empty or blocked reply: the same prompt gets the same verdict
+    code = getattr(e, "code", None)
+    return "429" not in str(e) and not (isinstance(code, int) and 400 <= code < 500)
+
+class RateLimiter:
+    """Sliding-window requests-per-minute gate, shared by every thread that calls wait()."""
+
+    def __init__(self, rpm, window=60.0):
+        self.rpm = rpm
+        self.window = window
+        self._sent = deque()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until one more request fits in the window, then records it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= self.window:
+                    self._sent.popleft()
+                if len(self._sent) < self.rpm:
+                    self._sent.append(now)
+                    return
+                delay = self.window - (now - self._sent[0])
+            time.sleep(delay)
+
+def call_gemini(model, prompt, attempts=3, generation_config=GENERATION_CONFIG, limiter=None):
+    """Transient failures retry with jittered backoff; 4xx errors, 429 included, go straight to the caller."""
+    for attempt in range(attempts):
+        if limiter:
+            limiter.wait()
+        try:
+            response = model.generate_content(
+                prompt, generation_config=generation_config, request_options=REQUEST_OPTIONS
+            )
+            return response.text.strip()
+        except Exception as e:
+            if not _retryable(e) or attempt == attempts - 1:
+                raise
+            time.sleep(_backoff(attempt))
+
+def _stream_text(first, rest, on_complete=None):
+    # A failure mid-stream propagates to the consumer: folding it into the
+    # text would let a truncated report be cached and exported as complete
+    parts = []
+    for chunk in itertools.chain([first] if first else [], rest):
+        if chunk.parts:
+            parts.append(chunk.text)
+            yield chunk.text
+    if not parts:
+        # Nothing came back (blocked by safety filters or an empty reply)
+        raise ValueError("Empty or blocked response from Gemini")
+    if on_complete:
+        on_complete("".join(parts).strip())
+
+def stream_gemini(model, prompt, attempts=3, on_complete=None, limiter=None):
+    """Like call_gemini, but hands back a text-chunk iterator once the first chunk is in.
+
+    on_complete gets the full text once the stream ends without an error.
+    """
+    for attempt in range(attempts):
+        if limiter:
+            limiter.wait()
+        try:
+            response = iter(model.generate_content(
+                prompt, generation_config=GENERATION_CONFIG, request_options=REQUEST_OPTIONS, stream=True
+            ))
+            # Errors such as 429 only surface on the first read, so read it here
+            first = next(response, None)
+            return _stream_text(first, response, on_complete)
+        except Exception as e:
+            if not _retryable(e) or attempt == attempts - 1:
+                raise
+            time.sleep(_backoff(attempt))
+
+# --- Word Export (python-docx, no Jinja render) ---
+_NAME_RE = re.compile(r"NAME_START:(.*?)NAME_END", re.S)
+_CAT_RE = re.compile(r"CATEGORY:\s*(READY|IMPROVE|MAJOR)")
+# Markers and markdown bold stripped in one pass over the report
+_SCRUB_RE = re.compile(r"NAME_START:.*?NAME_END|CATEGORY:.*?\n|\*\*|__", re.S)
+# (size, colour) per line kind, applied through paragraph styles, not per run
+_HEADER_FMT = (14, "1D457C")
+_BODY_FMT = (12, "E7E6E6")
+
+def _report_styles(doc, base_style):
+    """Returns the ReportHeader/ReportBody styles, adding them if the template lacks them."""
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.shared import Pt, RGBColor
+    existing = {style.name: style for style in doc.styles}
+    styles = []
+    for name, (size, color) in (("ReportHeader", _HEADER_FMT), ("ReportBody", _BODY_FMT)):
+        style = existing.get(name)
+        if style is None:
+            style = doc.styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+            style.base_style = base_style
+            style.font.name = 'Calibri'
+            style.font.size = Pt(size)
+            style.font.color.rgb = RGBColor.from_string(color)
+        styles.append(style)
+    return styles
+
+def fill_placeholders(paragraph, values):
+    """Replaces {{KEY}} markers in place, even when Word split them across runs."""
+    runs = paragraph.runs
+    i = 0
+    while i < len(runs):
+        if "{{" in runs[i].text:
+            j = i
+            while "}}" not in "".join(r.text for r in runs[i:j + 1]) and j + 1 < len(runs):
+                j += 1
+            merged = "".join(r.text for r in runs[i:j + 1])
+            for key, value in values.items():
+                merged = merged.replace("{{" + key + "}}", value)
+            runs[i].text = merged
+            for r in runs[i + 1:j + 1]:
+                r.text = ""
+            i = j
+        i += 1
+
+@lru_cache(maxsize=None)
+def _template_bytes():
+    # Read once per process; each report parses its own copy because rendering mutates it
+    with open(TEMPLATE_PATH, "rb") as f:
+        return f.read()
+
+# Recommendation checkboxes per category; parse_report only yields these keys
+_MARKS = {
+    "READY": {'REC_READY': "✅", 'REC_IMPROVE': "⬜", 'REC_MAJOR': "⬜"},
+    "IMPROVE": {'REC_READY': "⬜", 'REC_IMPROVE': "✅", 'REC_MAJOR': "⬜"},
+    "MAJOR": {'REC_READY': "⬜", 'REC_IMPROVE': "⬜", 'REC_MAJOR': "✅"},
+}
+
+# The prompt puts the NAME/CATEGORY markers first; leave room for a short preamble
+_META_HEAD_CHARS = 1000
+
+def parse_report(report_text):
+    """Splits a report into (body without markers, candidate name, category)."""
+    head = report_text[:_META_HEAD_CHARS]
+    name_match = _NAME_RE.search(head)
+    cand_name = name_match.group(1).strip() if name_match else "CANDIDATE"
+    cat_match = _CAT_RE.search(head)
+    category = cat_match.group(1) if cat_match else "IMPROVE"
+    return _SCRUB_RE.sub("", report_text), cand_name, category
+
+def create_word_report(report_text):
+    try:
+        from docx import Document
+        doc = Document(io.BytesIO(_template_bytes()))
+        clean_body, cand_name, category = parse_report(report_text)
+
+        # Report body goes in as real paragraphs in place of the placeholder
+        anchor = next(p for p in doc.paragraphs if "{{REPORT_CONTENT}}" in p.text)
+        header_style, body_style = _report_styles(doc, anchor.style)
+        for line in clean_body.splitlines():
+            line = line.strip()
+            if line.startswith('#'):
+                anchor.insert_paragraph_before(line.lstrip('#').lstrip(), header_style)
+            else:
+                anchor.insert_paragraph_before(line, body_style)
+        anchor._element.getparent().remove(anchor._element)
+
+        values = {'CANDIDATE_NAME': cand_name.upper(), **_MARKS[category]}
+        for paragraph in doc.paragraphs:
+            if "{{" in paragraph.text:
+                fill_placeholders(paragraph, values)
+        bio = io.BytesIO()
+        doc.save(bio)
+        bio.seek(0)
+        return bio
+    except: return None